@@ -4,16 +4,31 @@ Sistema de Código de Barras - Market
 Servidor Flask con base de datos CSV
 """
 
+import atexit
 import csv
 import io
+import json
+import math
+import mmap
 import os
+import re
+import shutil
+import stat
+import tempfile
 import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, make_response
+from types import MappingProxyType
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import generate_etag
 from facial_recognition import (
     register_user_face,
     recognize_face,
     has_facial_encoding,
+    facial_encoding_ids,
     delete_user_face
 )
 
@@ -22,7 +37,46 @@ try:
 except Exception:  # noqa: BLE001
     VisionPickService = None
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Proveedor JSON de Flask que serializa con orjson (en C) en vez de json"""
+
+    # Los arrays y escalares de NumPy (p. ej. distancias faciales) se
+    # serializan directo, sin pasar por tolist()/float()
+    options = orjson.OPT_SERIALIZE_NUMPY if orjson is not None else 0
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify(): bytes de orjson directo al Response, sin str intermedio
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self.options),
+                                         mimetype=self.mimetype)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 _pick_service_lock = threading.Lock()
 _pick_service = None
@@ -34,19 +88,53 @@ CARDS_FILE = 'cards.csv'
 
 PRODUCT_IMAGES_DIR = os.path.join('uploads', 'product_images')
 
+# Columnas fijas de products.csv (las demás, como imagen o sku_id, son extras)
+PRODUCT_BASE_FIELDS = ['codigo', 'nombre', 'categoria', 'precio', 'pais', 'proveedor', 'stock']
+
+USER_FIELDS = ['id', 'nombre', 'puntos', 'compras']
+CARD_FIELDS = ['id', 'numero_tarjeta', 'cvv', 'fecha_vencimiento', 'entidad_bancaria', 'tipo_tarjeta']
+
+# Las imágenes se versionan en la URL (?v=mtime), así el navegador puede cachearlas
+PRODUCT_IMAGE_MAX_AGE = 86400
+
+# Tamaño de bloque para copiar archivos subidos a disco (1 MiB)
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Productos por parte al enviar /api/products por streaming
+JSON_STREAM_BATCH = 256
+
+# Buffer de lectura/escritura de los CSV: pocos read()/write() grandes en vez
+# de muchos de 8 KiB
+CSV_BUFFER_SIZE = 1 << 20
+
+# Tamaño máximo de un request (imágenes de productos, fotos en base64)
+MAX_UPLOAD_SIZE = 8 << 20
+
+# Espera del escritor diferido para juntar modificaciones en ráfaga (segundos)
+WRITE_BEHIND_DELAY = 0.05
+
+ALLOWED_IMAGE_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.webp'})
+
+# Detrás de nginx: prefijo de la location `internal` que sirve las imágenes
+# (X-Accel-Redirect). Con Apache/lighttpd usar X_SENDFILE=1 (X-Sendfile).
+PRODUCT_IMAGES_ACCEL_PREFIX = os.environ.get('PRODUCT_IMAGES_ACCEL_PREFIX', '')
+app.use_x_sendfile = os.environ.get('X_SENDFILE') == '1'
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
+
 # Porcentaje de reintegro en compras (10%)
 REINTEGRO_PORCENTAJE = 10
 
 # Diccionarios de referencia para códigos de barras
-PAISES = {
+PAISES = MappingProxyType({
     "13": "Paraguay",
     "45": "Argentina",
     "50": "Brasil",
     "78": "México",
     "84": "España",
-}
+})
 
-CATEGORIAS = [
+CATEGORIAS = (
     "Bebidas",
     "Alimentos",
     "Lácteos",
@@ -55,15 +143,25 @@ CATEGORIAS = [
     "Limpieza",
     "Higiene",
     "Otros"
-]
+)
 
-PROVEEDORES = {
+PROVEEDORES = MappingProxyType({
     "64": "Proveedor Guaraní S.A.",
     "12": "Distribuidora Mercosur",
     "45": "TechPlus Importaciones",
     "33": "Importadora del Este",
     "77": "Comercial Paraguay",
-}
+})
+
+# Los diccionarios son de solo lectura, así que sus .get se pueden enlazar una vez
+_PAISES_GET = PAISES.get
+_PROVEEDORES_GET = PROVEEDORES.get
+
+# Todo lo que no sea dígito (para normalizar números de tarjeta y CVV)
+_NON_DIGITS_RE = re.compile(r'\D+')
+# Formatos válidos ya normalizados: número de 13 a 19 dígitos, CVV de 3 o 4
+CARD_NUMBER_RE = re.compile(r'\d{13,19}')
+CVV_RE = re.compile(r'\d{3,4}')
 
 # Entidades bancarias disponibles
 ENTIDADES_BANCARIAS = [
@@ -80,83 +178,796 @@ ENTIDADES_BANCARIAS = [
     "Otra entidad bancaria"
 ]
 
+TIPOS_TARJETA = frozenset(('Débito', 'Crédito'))
+
+# Campos obligatorios al dar de alta un producto o una tarjeta
+PRODUCT_REQUIRED_FIELDS = ('codigo', 'nombre', 'categoria', 'precio', 'pais', 'proveedor', 'stock')
+CARD_REQUIRED_FIELDS = ('numero_tarjeta', 'cvv', 'fecha_vencimiento', 'entidad_bancaria', 'tipo_tarjeta')
+
+
+def _file_mode(path):
+    """Permisos del archivo; si no existe, los que tendría uno nuevo (0666 menos el umask)"""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def _atomic_write_csv(path, fieldnames, rows):
+    """
+    Escribe un CSV de forma atómica: primero a un archivo temporal en el mismo
+    directorio y luego lo reemplaza con os.replace, así los lectores nunca ven
+    un archivo a medio escribir.
+    """
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), delete=False,
+                                      mode='w', newline='', encoding='utf-8',
+                                      buffering=CSV_BUFFER_SIZE)
+    try:
+        with tmp:
+            writer = csv.writer(tmp)
+            writer.writerow(fieldnames)
+            writer.writerows([row.get(field, '') for field in fieldnames] for row in rows)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        # NamedTemporaryFile crea el archivo con permisos 0600: se le dan los
+        # del archivo que reemplaza (o los de un archivo nuevo según el umask)
+        os.chmod(tmp.name, _file_mode(path))
+        os.replace(tmp.name, path)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
 
 def init_users_file():
     """Inicializa el archivo de usuarios con el usuario por defecto"""
     if not os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=['id', 'nombre', 'puntos', 'compras'])
-            writer.writeheader()
-            writer.writerow({
-                'id': '1',
-                'nombre': 'Caleb Medina',
-                'puntos': '1000',
-                'compras': '0'
-            })
+        _atomic_write_csv(USERS_FILE, USER_FIELDS, [{
+            'id': '1',
+            'nombre': 'Caleb Medina',
+            'puntos': '1000',
+            'compras': '0'
+        }])
 
 
 def init_cards_file():
     """Inicializa el archivo de tarjetas si no existe"""
     if not os.path.exists(CARDS_FILE):
-        with open(CARDS_FILE, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=['id', 'numero_tarjeta', 'cvv', 'fecha_vencimiento', 'entidad_bancaria', 'tipo_tarjeta'])
-            writer.writeheader()
+        _atomic_write_csv(CARDS_FILE, CARD_FIELDS, [])
+
+
+# Rango de enteros que orjson puede serializar
+_INT64_MIN = -2 ** 63
+_UINT64_LIMIT = 2 ** 64
+
+
+def _to_number(value):
+    """
+    Convierte a int o float si es posible; si no, deja el valor tal cual. Los
+    enteros que no entran en 64 bits quedan como texto: orjson no
+    los serializa.
+    """
+    if isinstance(value, str):
+        try:
+            number = int(value)
+        except ValueError:
+            pass
+        else:
+            return number if _INT64_MIN <= number < _UINT64_LIMIT else value
+    elif isinstance(value, int) and not isinstance(value, bool):
+        # Un int de JSON fuera de rango queda como texto, igual que en el CSV
+        return value if _INT64_MIN <= value < _UINT64_LIMIT else str(value)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return value
+    # nan/inf no son JSON válido
+    if not math.isfinite(number):
+        return value
+    if number.is_integer():
+        if _INT64_MIN <= number < _UINT64_LIMIT:
+            return int(number)
+        # Un texto como '1e30' queda como está; un float de JSON sigue siendo float
+        return value if isinstance(value, str) else number
+    return number
+
+
+def _json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _stat_stamp(path):
+    """
+    (mtime en ns, tamaño) del archivo, o None si no existe. El mtime en
+    float pierde precisión y dos escrituras seguidas pueden coincidir; el
+    tamaño cubre además los agregados dentro del mismo tick del reloj.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _to_int(value):
+    """Convierte a int si es posible; si no, deja el valor tal cual"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class CSVStore:
+    """
+    Caché en memoria de un archivo CSV, indexada por una columna clave.
+
+    El archivo se lee una sola vez y se vuelve a leer sólo si cambia su fecha
+    de modificación (en nanosegundos) o su tamaño, o el de su diario. Las
+    operaciones modifican las filas en memoria y WriteBehind las persiste poco
+    después con flush(): altas, modificaciones y bajas se agregan a
+    <archivo>.journal (una línea JSON por fila) y el CSV se reescribe sólo al
+    compactar el diario. Con varios workers (gunicorn) cada proceso tiene su
+    propia caché, por eso las modificaciones toman además un flock sobre
+    <archivo>.lock, releen el CSV antes de aplicar el cambio y mantienen el
+    flock hasta que el cambio queda escrito.
+    """
+
+    key = None
+    # Columnas de las que dependen los índices; cambiarlas obliga a reindexar
+    indexed_fields = ()
+    # Columnas numéricas: en memoria se guardan como int, al escribir vuelven a texto
+    int_fields = ()
+    # Igual, pero admiten decimales (int si el valor es entero, si no float)
+    number_fields = ()
+    # Claves numéricas correlativas: se lleva el mayor ID y las altas sin
+    # clave reciben el siguiente
+    sequential_key = False
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.rows = []
+        self.fieldnames = []
+        # Encabezado del archivo en disco (None si no existe)
+        self.file_fields = None
+        self.by_key = {}
+        self.stamp = None
+        # Aumenta con cada cambio de las filas (en memoria o releídas del disco)
+        self.version = 0
+        self.lock = threading.RLock()
+        self._loaded = False
+        # Cambios en memoria todavía no escritos en el diario (ver WriteBehind)
+        self._journal = []
+        self._journal_lines = 0
+        self._lock_file = None
+
+    def _file_stamp(self):
+        return _stat_stamp(self.path), _stat_stamp(self.journal_path)
+
+    @contextmanager
+    def _open(self):
+        with open(self.path, 'r', encoding='utf-8', newline='', buffering=CSV_BUFFER_SIZE) as file:
+            yield file
+
+    def _parse(self):
+        """Retorna (encabezado, filas) del CSV; las filas cortas se completan con ''"""
+        rows = []
+        with self._open() as file:
+            reader = csv.reader(file)
+            fieldnames = next(reader, [])
+            width = len(fieldnames)
+            for values in reader:
+                if not values:
+                    continue
+                if len(values) < width:
+                    values += [''] * (width - len(values))
+                rows.append(dict(zip(fieldnames, values)))
+        return fieldnames, rows
+
+    def _load(self):
+        # La marca se toma antes de leer: si otro worker cambia el archivo
+        # mientras tanto, la marca guardada ya no coincide y se vuelve a leer
+        stamp = self._file_stamp()
+        rows = []
+        fieldnames = []
+        if os.path.exists(self.path):
+            fieldnames, rows = self._parse()
+            for row in rows:
+                self._coerce(row)
+        self._journal_lines = 0
+        rows = self._replay_journal(rows)
+        self.rows = rows
+        self.fieldnames = []
+        self._track_fields(fieldnames)
+        self.file_fields = fieldnames or None
+        self.stamp = stamp
+        self._loaded = True
+        self._build_indexes()
+        self._invalidate()
+
+    def _replay_journal(self, rows):
+        """Aplica sobre las filas del CSV los cambios registrados en el diario"""
+        if not os.path.exists(self.journal_path):
+            return rows
+        by_key = {row.get(self.key): row for row in reversed(rows)}
+        with open(self.journal_path, 'rb', buffering=CSV_BUFFER_SIZE) as file:
+            for line in file:
+                try:
+                    record = _json_loads(line)
+                except ValueError:
+                    # Línea incompleta (corte durante una escritura)
+                    continue
+                self._journal_lines += 1
+                if record.get('op') == 'del':
+                    key = record.get('key')
+                    if by_key.pop(key, None) is not None:
+                        rows = [row for row in rows if row.get(self.key) != key]
+                    continue
+                # Cambio de clave: la fila conserva su lugar en el archivo
+                old_key = record.get('from')
+                record = record.get('row') or {}
+                key = record.get(self.key)
+                self._coerce(record)
+                self._track_fields(record)
+                row = by_key.get(key)
+                if old_key is not None and old_key != key and old_key in by_key:
+                    if row is not None:
+                        rows = [r for r in rows if r is not row]
+                    row = by_key.pop(old_key)
+                    by_key[key] = row
+                if row is None:
+                    by_key[key] = record
+                    rows.append(record)
+                else:
+                    row.clear()
+                    row.update(record)
+        return rows
+
+    def _build_indexes(self):
+        self.by_key = {}
+        self.max_id = 0
+        for row in self.rows:
+            self._index_row(row)
+
+    def _index_row(self, row):
+        self.by_key.setdefault(row.get(self.key), row)
+        if self.sequential_key:
+            row_id = _to_int(row.get(self.key))
+            if isinstance(row_id, int) and row_id > self.max_id:
+                self.max_id = row_id
+
+    def _unindex_row(self, row, values):
+        """Quita la fila de los índices; values tiene sus valores indexados anteriores"""
+        key = values.get(self.key)
+        if self.by_key.get(key) is row:
+            del self.by_key[key]
+            # Igual que al releer el archivo: el siguiente ID sale de las filas
+            # que quedan, así que se recalcula si se quitó la del mayor
+            if self.sequential_key and _to_int(key) == self.max_id:
+                ids = (_to_int(k) for k in self.by_key)
+                self.max_id = max((i for i in ids if isinstance(i, int)), default=0)
+
+    def _coerce(self, row):
+        for field in self.int_fields:
+            if field in row:
+                row[field] = _to_int(row[field])
+        for field in self.number_fields:
+            if field in row:
+                row[field] = _to_number(row[field])
+
+    def _track_fields(self, keys):
+        """Registra columnas nuevas que aparecen al agregar o modificar filas"""
+        self.fieldnames.extend(k for k in keys if k not in self.fieldnames)
+
+    def _refresh(self):
+        """Recarga el CSV si todavía no se leyó o si cambió en disco"""
+        if not self._loaded or self._file_stamp() != self.stamp:
+            self._load()
+
+    def _header(self):
+        """Columnas con las que _write escribe el archivo"""
+        raise NotImplementedError
+
+    def _write(self, rows):
+        raise NotImplementedError
+
+    def _invalidate(self):
+        """Se llama cada vez que cambian las filas (para cachés derivadas)"""
+        self.version += 1
+
+    def _append_journal(self, records):
+        """
+        Agrega los cambios al diario, uno por línea. Cada línea es un sobre
+        {"op": "upsert", "from": <clave anterior>, "row": {...}} o
+        {"op": "del", "key": <clave>}: los datos de la fila nunca se mezclan
+        con los del diario.
+        """
+        # Las filas se serializan con su estado actual, así que de una fila
+        # modificada varias veces basta con una línea, en su primera aparición
+        # (así las altas quedan en el mismo orden que en memoria). Sólo un
+        # cambio de clave abre otra línea; la anterior deja la fila con la
+        # clave que tenía hasta ese cambio.
+        entries = []
+        latest = {}
+        for record in records:
+            if record['op'] == 'upsert':
+                i = latest.get(id(record['row']))
+                if i is not None:
+                    if 'from' not in record:
+                        continue
+                    entries[i]['key'] = record['from']
+                latest[id(record['row'])] = len(entries)
+            entries.append(dict(record))
+        header = self._header()
+        lines = []
+        for record in entries:
+            if record['op'] == 'upsert':
+                row = {field: record['row'].get(field, '') for field in header}
+                if 'key' in record:
+                    row[self.key] = record.pop('key')
+                record['row'] = row
+            lines.append(_json_dumps(record))
+        with open(self.journal_path, 'ab') as file:
+            file.write(b'\n'.join(lines) + b'\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self._journal_lines += len(lines)
+
+    def _rewrite(self):
+        """Reescribe el CSV completo y descarta el diario (compactación)"""
+        self._write(self.rows)
+        self.file_fields = self._header()
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+        self._journal_lines = 0
+
+    def _lock_file_acquire(self):
+        if fcntl is None:
+            return
+        self._lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _lock_file_release(self):
+        if self._lock_file is None:
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+    @contextmanager
+    def _mutation(self):
+        """
+        Sección crítica de una modificación, exclusiva entre hilos y procesos.
+
+        Si quedan cambios sin escribir, el flock sigue tomado desde la
+        modificación anterior: la caché es la versión vigente y no se relee.
+        """
+        with self.lock:
+            if not self._has_pending():
+                self._lock_file_acquire()
+            try:
+                # Dentro del try: si la relectura falla, el flock no queda tomado
+                if not self._has_pending():
+                    self._refresh()
+                yield
+            finally:
+                if not self._has_pending():
+                    self._lock_file_release()
+
+    def _has_pending(self):
+        return bool(self._journal)
+
+    def _mark_dirty(self, row=None, deleted=None):
+        """
+        Registra un cambio en memoria; el flusher lo escribe en segundo plano.
+
+        row es la fila agregada o modificada y deleted la clave que dejó de
+        existir (por una baja o porque la fila cambió de clave).
+        """
+        if row is None:
+            self._journal.append({'op': 'del', 'key': deleted})
+        elif deleted is not None:
+            self._journal.append({'op': 'upsert', 'from': deleted, 'row': row})
+        else:
+            self._journal.append({'op': 'upsert', 'row': row})
+        self._invalidate()
+        write_behind.schedule(self)
+
+    def all(self):
+        """Retorna las filas en memoria (no modificarlas sin llamar a flush)"""
+        with self.lock:
+            self._refresh()
+            return self.rows
+
+    def current_version(self):
+        """Versión de los datos tras releer el archivo si cambió (sirve de clave de caché)"""
+        with self.lock:
+            self._refresh()
+            return self.version
+
+    def get(self, key):
+        """Busca una fila por su clave"""
+        with self.lock:
+            self._refresh()
+            return self.by_key.get(key)
+
+    def _conflicts(self, row, current=None):
+        """
+        True si la fila viola una restricción de unicidad (por defecto, la
+        clave). current es la clave de la fila que se está modificando, que no
+        choca consigo misma.
+        """
+        owner = self.by_key.get(row.get(self.key))
+        return owner is not None and (current is None or owner is not self.by_key.get(current))
+
+    def _next_key(self):
+        """Clave para una fila agregada sin clave; None si el store no las genera"""
+        if self.sequential_key:
+            # El mayor ID existente + 1
+            return str(self.max_id + 1)
+        return None
+
+    def add(self, row, fill=None):
+        """
+        Agrega una fila; retorna la fila almacenada o None si ya existe otra con
+        la misma clave (o con un valor único repetido). La verificación ocurre
+        dentro de la sección crítica, así dos altas simultáneas no pueden
+        duplicarse. Sin clave en la fila, se asigna la siguiente (_next_key);
+        fill recibe la clave asignada y retorna las columnas que dependen de
+        ella (p. ej. el nombre por defecto de un usuario).
+        """
+        with self._mutation():
+            # Igual que al leer del CSV: las columnas ausentes quedan vacías
+            stored = dict.fromkeys(self.fieldnames, '')
+            stored.update(row)
+            if not stored.get(self.key):
+                stored[self.key] = self._next_key()
+            if fill is not None:
+                stored.update(fill(stored[self.key]))
+            if self._conflicts(stored):
+                return None
+            self._coerce(stored)
+            self._track_fields(stored)
+            self.rows.append(stored)
+            self._index_row(stored)
+            self._mark_dirty(row=stored)
+            return stored
+
+    def update(self, key, changes):
+        """
+        Actualiza una fila existente; retorna la fila, None si no existe o
+        False si el cambio repetiría la clave (o un valor único) de otra fila.
+        """
+        with self._mutation():
+            row = self.by_key.get(key)
+            if row is None:
+                return None
+            # Si cambia una columna indexada, se actualizan sólo las entradas de esta fila
+            reindex = self.key in changes or any(f in changes for f in self.indexed_fields)
+            if reindex:
+                candidate = dict(row, **changes)
+                self._coerce(candidate)
+                if self._conflicts(candidate, current=key):
+                    return False
+                values = {f: row.get(f, '') for f in (self.key,) + self.indexed_fields}
+            row.update(changes)
+            self._coerce(row)
+            self._track_fields(changes)
+            if reindex:
+                self._unindex_row(row, values)
+                self._index_row(row)
+            self._mark_dirty(row=row, deleted=key if row.get(self.key) != key else None)
+            return row
+
+    def delete(self, key):
+        """Elimina las filas con la clave dada; retorna False si no existía"""
+        with self._mutation():
+            if key not in self.by_key:
+                return False
+            kept = []
+            for row in self.rows:
+                if row.get(self.key) != key:
+                    kept.append(row)
+                else:
+                    self._unindex_row(row, row)
+            self.rows = kept
+            self._mark_dirty(deleted=key)
+            return True
+
+    def flush(self):
+        """
+        Escribe los cambios pendientes en el diario, que se compacta (se
+        reescribe el CSV) cuando tiene más del doble de líneas que filas vivas.
+        """
+        with self.lock:
+            if not self._has_pending():
+                return
+            self._append_journal(self._journal)
+            if self._journal_lines > 2 * len(self.rows):
+                self._rewrite()
+            self._journal = []
+            self.stamp = self._file_stamp()
+            self._lock_file_release()
+
+
+class WriteBehind:
+    """
+    Escritura diferida de los CSVStore.
+
+    Las modificaciones marcan el store como pendiente y vuelven enseguida; un
+    hilo espera WRITE_BEHIND_DELAY para juntar las que lleguen en ráfaga y las
+    agrega al diario con una sola escritura por archivo.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.stores = []
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def register(self, store):
+        self.stores.append(store)
+        return store
+
+    def schedule(self, store):
+        with self._lock:
+            # Los hilos no sobreviven al fork de gunicorn: cada worker arranca el suyo
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='csv-write-behind', daemon=True)
+                self._thread.start()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            time.sleep(self.delay)
+            self._event.clear()
+            try:
+                self.flush_all()
+            except Exception:  # noqa: BLE001
+                # Los cambios siguen pendientes; se reintenta en el próximo cambio o al salir
+                app.logger.exception('Error al escribir los CSV')
+
+    def flush_all(self):
+        for store in self.stores:
+            store.flush()
+
+
+class ProductStore(CSVStore):
+    key = 'codigo'
+    number_fields = ('precio', 'stock')
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.extra_fields = set()
+        self._json_cache = None
+        self._json_etag = None
+
+    def _track_fields(self, keys):
+        super()._track_fields(keys)
+        self.extra_fields.update(k for k in keys if k not in PRODUCT_BASE_FIELDS)
+
+    def _load(self):
+        self.extra_fields = set()
+        super()._load()
+
+    def _parse(self):
+        if pa_csv is not None:
+            try:
+                return self._parse_arrow()
+            except (pyarrow.ArrowInvalid, UnicodeDecodeError):
+                # Casos que pyarrow no acepta (archivo vacío, filas cortas):
+                # los resuelve el lector de csv
+                pass
+        return super()._parse()
+
+    def _parse_arrow(self):
+        """Parsea products.csv con pyarrow (en C++, multihilo); todo como texto"""
+        with open(self.path, 'r', encoding='utf-8', newline='') as file:
+            fieldnames = next(csv.reader(file), [])
+        table = pa_csv.read_csv(
+            self.path,
+            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={name: pyarrow.string() for name in fieldnames},
+                strings_can_be_null=False
+            )
+        )
+        return fieldnames, table.to_pylist()
+
+    @contextmanager
+    def _open(self):
+        """Lee products.csv mapeado en memoria y lo decodifica directo desde el mapeo"""
+        with open(self.path, 'rb') as raw:
+            if os.fstat(raw.fileno()).st_size == 0:
+                yield io.StringIO('')
+                return
+            with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield io.StringIO(str(mapped, 'utf-8'), newline='')
+
+    def _invalidate(self):
+        super()._invalidate()
+        self._json_cache = None
+        self._json_etag = None
+
+    def cached_json(self):
+        """(cuerpo, etag) de /api/products si ya está serializado; si no, (None, None)"""
+        with self.lock:
+            self._refresh()
+            return self._json_cache, self._json_etag
+
+    def json_chunks(self):
+        """
+        Cuerpo de /api/products por partes. Si ya está serializado se entrega
+        entero; si no, se serializa por lotes mientras se envía y queda
+        guardado para los próximos requests (salvo que el catálogo cambie
+        mientras tanto).
+        """
+        with self.lock:
+            self._refresh()
+            cached = self._json_cache
+            rows = list(self.rows) if cached is None else None
+            version = self.version
+        if cached is not None:
+            yield cached
+            return
+        parts = [b'{"success":true,"products":[']
+        yield parts[0]
+        for start in range(0, len(rows), JSON_STREAM_BATCH):
+            chunk = b','.join(_json_dumps(row) for row in rows[start:start + JSON_STREAM_BATCH])
+            if start:
+                chunk = b',' + chunk
+            parts.append(chunk)
+            yield chunk
+        parts.append(b']}')
+        yield parts[-1]
+        with self.lock:
+            if self.version == version:
+                self._json_cache = b''.join(parts)
+                self._json_etag = generate_etag(self._json_cache)
+
+    def _header(self):
+        # Las columnas extra ya se conocen: no hace falta recorrer todas las filas
+        return PRODUCT_BASE_FIELDS + sorted(self.extra_fields)
+
+    def _write(self, rows):
+        write_products(rows, self._header())
+
+
+class CardStore(CSVStore):
+    key = 'id'
+    indexed_fields = ('numero_tarjeta',)
+    sequential_key = True
+
+    def _build_indexes(self):
+        self.by_numero = {}
+        super()._build_indexes()
+
+    def _index_row(self, row):
+        super()._index_row(row)
+        self.by_numero.setdefault(row.get('numero_tarjeta', ''), row.get(self.key))
+
+    def _unindex_row(self, row, values):
+        super()._unindex_row(row, values)
+        numero = values.get('numero_tarjeta', '')
+        if self.by_numero.get(numero) == values.get(self.key):
+            del self.by_numero[numero]
+
+    def _conflicts(self, row, current=None):
+        return (super()._conflicts(row, current)
+                or self.by_numero.get(row.get('numero_tarjeta')) not in (None, current))
+
+    def _header(self):
+        return CARD_FIELDS
+
+    def _write(self, rows):
+        write_cards(rows)
+
+
+class UserStore(CSVStore):
+    key = 'id'
+    indexed_fields = ('nombre',)
+    int_fields = ('puntos',)
+    sequential_key = True
+
+    def _build_indexes(self):
+        self.by_nombre_lower = {}
+        # Cantidad de usuarios con cada nombre (el índice guarda sólo el primero)
+        self._name_counts = {}
+        super()._build_indexes()
+
+    def _index_row(self, row):
+        super()._index_row(row)
+        nombre = row.get('nombre', '').lower()
+        self.by_nombre_lower.setdefault(nombre, row.get(self.key))
+        self._name_counts[nombre] = self._name_counts.get(nombre, 0) + 1
+
+    def _unindex_row(self, row, values):
+        super()._unindex_row(row, values)
+        nombre = values.get('nombre', '').lower()
+        count = self._name_counts.pop(nombre, 1) - 1
+        if count:
+            self._name_counts[nombre] = count
+        if self.by_nombre_lower.get(nombre) == values.get(self.key):
+            del self.by_nombre_lower[nombre]
+            if count:
+                # Otro usuario tiene el mismo nombre: pasa a ser el dueño, el
+                # primero en el archivo, igual que al releerlo
+                for other in self.rows:
+                    if other is not row and other.get('nombre', '').lower() == nombre:
+                        self.by_nombre_lower[nombre] = other.get(self.key)
+                        break
+
+    def _conflicts(self, row, current=None):
+        # Los nombres son únicos sin distinguir mayúsculas
+        return (super()._conflicts(row, current)
+                or self.by_nombre_lower.get(row.get('nombre', '').lower()) not in (None, current))
+
+    def _header(self):
+        return USER_FIELDS
+
+    def _write(self, rows):
+        write_users(rows)
+
+
+write_behind = WriteBehind(WRITE_BEHIND_DELAY)
+product_store = write_behind.register(ProductStore(CSV_FILE))
+user_store = write_behind.register(UserStore(USERS_FILE))
+card_store = write_behind.register(CardStore(CARDS_FILE))
+# Lo pendiente se escribe antes de terminar el proceso
+atexit.register(write_behind.flush_all)
+
+
+def flush_all():
+    """Escribe ya todos los cambios pendientes en los CSV"""
+    write_behind.flush_all()
+
+# Inicializar archivos y precargar las cachés al importar el módulo: con
+# `gunicorn --preload` esto ocurre una sola vez en el proceso maestro y los
+# workers heredan los datos ya cargados. Los encodings faciales no se
+# precargan: la conexión SQLite no puede pasar por el fork, así que cada
+# worker abre la suya y los lee en su primera consulta.
+init_users_file()
+init_cards_file()
+for _store in (product_store, user_store, card_store):
+    _store.all()
 
 
 def read_cards():
-    """Lee todas las tarjetas del CSV"""
-    cards = []
-    if os.path.exists(CARDS_FILE):
-        with open(CARDS_FILE, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                cards.append(row)
-    return cards
+    """Lee todas las tarjetas (desde la caché en memoria)"""
+    return card_store.all()
 
 
 def write_cards(cards):
-    """Escribe las tarjetas al CSV"""
-    if cards:
-        fieldnames = ['id', 'numero_tarjeta', 'cvv', 'fecha_vencimiento', 'entidad_bancaria', 'tipo_tarjeta']
-        with open(CARDS_FILE, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(cards)
-    else:
-        # Si no hay tarjetas, solo escribir el encabezado
-        with open(CARDS_FILE, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=['id', 'numero_tarjeta', 'cvv', 'fecha_vencimiento', 'entidad_bancaria', 'tipo_tarjeta'])
-            writer.writeheader()
+    """Escribe las tarjetas al CSV (si no hay tarjetas, solo el encabezado)"""
+    _atomic_write_csv(CARDS_FILE, CARD_FIELDS, cards)
 
 
 def find_card_by_id(card_id):
     """Busca una tarjeta por su ID"""
-    cards = read_cards()
-    for card in cards:
-        if card['id'] == card_id:
-            return card
-    return None
+    return card_store.get(card_id)
 
 
 def read_users():
-    """Lee todos los usuarios del CSV"""
-    users = []
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                users.append(row)
-    return users
+    """Lee todos los usuarios (desde la caché en memoria)"""
+    return user_store.all()
 
 
 def write_users(users):
     """Escribe los usuarios al CSV"""
-    if users:
-        fieldnames = ['id', 'nombre', 'puntos', 'compras']
-        with open(USERS_FILE, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(users)
+    _atomic_write_csv(USERS_FILE, USER_FIELDS, users)
 
 
 def get_default_user():
@@ -172,8 +983,16 @@ def get_default_user():
     return None
 
 
+def only_digits(value):
+    """Elimina todo lo que no sea dígito (espacios, guiones, etc.)"""
+    return _NON_DIGITS_RE.sub('', str(value))
+
+
 def calculate_product_points(precio):
     """Calcula los puntos de un producto basado en su precio (1 punto por cada 100 guaraníes)"""
+    # Los precios de la caché ya son números: un entero se divide sin pasar a float
+    if isinstance(precio, int) and precio >= 0:
+        return precio // 100
     return int(float(precio) / 100)
 
 
@@ -183,43 +1002,128 @@ def calculate_reintegro(puntos_usados):
 
 
 def read_products():
-    """Lee todos los productos del CSV"""
-    products = []
-    if os.path.exists(CSV_FILE):
-        with open(CSV_FILE, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                products.append(row)
-    return products
-
-
-def write_products(products):
-    """Escribe los productos al CSV"""
-    if products:
-        base_fields = ['codigo', 'nombre', 'categoria', 'precio', 'pais', 'proveedor', 'stock']
+    """Lee todos los productos (desde la caché en memoria)"""
+    return product_store.all()
+
+
+def write_products(products, fieldnames=None):
+    """Escribe los productos al CSV (si no se indican las columnas, se deducen de las filas)"""
+    if fieldnames is None:
         extras = set()
         for p in products:
             for k in p.keys():
-                if k not in base_fields:
+                if k not in PRODUCT_BASE_FIELDS:
                     extras.add(k)
-        fieldnames = base_fields + sorted(extras)
-        with open(CSV_FILE, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(products)
+        fieldnames = PRODUCT_BASE_FIELDS + sorted(extras)
+    _atomic_write_csv(CSV_FILE, fieldnames, products)
 
 
 def find_product_by_code(code):
     """Busca un producto por su código de barras"""
-    products = read_products()
-    for product in products:
-        if product['codigo'] == code:
-            return product
-    return None
+    return product_store.get(code)
+
+
+def save_uploaded_file(upload, path):
+    """Copia un archivo subido a disco en bloques, sin cargarlo entero en memoria"""
+    with open(path, 'wb', buffering=UPLOAD_CHUNK_SIZE) as dst:
+        shutil.copyfileobj(upload.stream, dst, length=UPLOAD_CHUNK_SIZE)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+
+def facial_request(image_field):
+    """
+    Retorna (datos, imagen) del request. La imagen puede llegar como archivo
+    en un multipart/form-data (bytes, sin base64) o, como antes, en base64
+    dentro del JSON; en ambos casos va en el campo image_field.
+    """
+    upload = request.files.get(image_field)
+    if upload is not None:
+        return request.form, upload.read()
+    data = request.get_json(silent=True) or {}
+    return data, data.get(image_field)
+
+
+def is_supported_image(stream):
+    """Verifica por los primeros bytes (magic number) que el archivo sea jpg, png o webp"""
+    header = stream.read(12)
+    stream.seek(0)
+    return (header.startswith(b'\xff\xd8\xff')
+            or header.startswith(b'\x89PNG\r\n\x1a\n')
+            or (header[:4] == b'RIFF' and header[8:12] == b'WEBP'))
+
+
+class StaticJSON:
+    """
+    Respuesta JSON fija (errores frecuentes): el cuerpo se serializa una sola
+    vez y cada llamada arma un Response nuevo, porque un Response no se puede
+    compartir entre requests.
+    """
+
+    def __init__(self, payload):
+        self.body = _json_dumps(payload)
+
+    def __call__(self):
+        return app.response_class(self.body, mimetype='application/json')
+
+
+TARJETA_NO_ENCONTRADA = StaticJSON({'success': False, 'message': 'Tarjeta no encontrada'})
+PRODUCTO_NO_ENCONTRADO = StaticJSON({'success': False, 'message': 'Producto no encontrado'})
+USUARIO_NO_ENCONTRADO = StaticJSON({'success': False, 'message': 'Usuario no encontrado'})
+VISION_NO_DISPONIBLE = StaticJSON({
+    'success': False,
+    'message': 'VisionPickService no disponible (dependencias faltantes o import falló)'
+})
+
+
+def conditional_json(payload, private=False):
+    """
+    jsonify() con ETag del contenido: si el cliente ya tiene esa versión
+    (If-None-Match) se responde 304 sin cuerpo. no-cache obliga a revalidar
+    siempre; private evita que un proxy guarde datos sensibles.
+    """
+    response = jsonify(payload)
+    response.add_etag()
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    return response.make_conditional(request)
+
+
+# HTML ya renderizado por template: (clave, html)
+_render_cache = {}
+
+
+def render_cached(template, key=None, context=dict):
+    """
+    Renderiza un template y reutiliza el HTML mientras key no cambie.
+    context arma las variables del template y sólo se llama al renderizar.
+    En modo debug se renderiza siempre, para ver los cambios del template.
+    """
+    if not app.debug:
+        cached = _render_cache.get(template)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    html = render_template(template, **context())
+    _render_cache[template] = (key, html)
+    return html
+
+
+def product_image_url(filename):
+    """URL pública de la imagen de un producto, con la versión del archivo para cache-busting"""
+    url = f"/uploads/product_images/{filename}"
+    try:
+        return f"{url}?v={os.stat(os.path.join(PRODUCT_IMAGES_DIR, filename)).st_mtime_ns}"
+    except OSError:
+        return url
 
 
+@lru_cache(maxsize=4096)
 def decode_barcode(code):
-    """Decodifica información del código de barras según su estructura"""
+    """
+    Decodifica información del código de barras según su estructura.
+    El resultado se memoiza y se comparte entre llamadas: no modificarlo.
+    """
     if len(code) < 7:
         return None
     
@@ -229,104 +1133,116 @@ def decode_barcode(code):
     
     return {
         'pais_codigo': pais_id,
-        'pais_nombre': PAISES.get(pais_id, "Desconocido"),
+        'pais_nombre': _PAISES_GET(pais_id, "Desconocido"),
         'producto_id': producto_id,
         'proveedor_codigo': proveedor_id,
-        'proveedor_nombre': PROVEEDORES.get(proveedor_id, "Desconocido")
+        'proveedor_nombre': _PROVEEDORES_GET(proveedor_id, "Desconocido")
     }
 
 
 @app.route('/')
 def index():
     """Página principal"""
-    return render_template('index.html')
+    return render_cached('index.html')
 
 
 @app.route('/scanner')
 def scanner():
     """Página del escáner de códigos de barras"""
-    return render_template('scanner.html')
+    return render_cached('scanner.html')
 
 
 @app.route('/creator')
 def creator():
     """Página para crear códigos de barras"""
-    return render_template('creator.html', 
-                         paises=PAISES, 
-                         categorias=CATEGORIAS,
-                         proveedores=PROVEEDORES)
+    # Sólo depende de catálogos inmutables: se renderiza una vez por proceso
+    return render_cached('creator.html', context=lambda: {
+        'paises': PAISES,
+        'categorias': CATEGORIAS,
+        'proveedores': PROVEEDORES,
+    })
 
 
 @app.route('/inventory')
 def inventory():
     """Página de inventario"""
-    products = read_products()
-    return render_template('inventory.html', products=products)
+    # Se vuelve a renderizar sólo cuando cambian los productos
+    return render_cached('inventory.html', product_store.current_version(),
+                         lambda: {'products': read_products()})
 
 
 @app.route('/vision')
 def vision_dashboard():
     """Dashboard para controlar el servicio de visión y ver eventos PICK"""
-    return render_template('vision_dashboard.html')
+    return render_cached('vision_dashboard.html')
 
 
 @app.route('/inventory/export')
 def inventory_export():
     products = read_products()
-    fieldnames = ['codigo', 'nombre', 'categoria', 'precio', 'pais', 'proveedor', 'stock']
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    for p in products:
-        writer.writerow({k: p.get(k, '') for k in fieldnames})
-
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = 'attachment; filename=inventory_export.csv'
-    return response
+    fieldnames = PRODUCT_BASE_FIELDS
+
+    def generate():
+        # Un único buffer pequeño que se vacía después de cada fila
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        for p in products:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+            writer.writerow(p)
+        yield output.getvalue()
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=inventory_export.csv'})
 
 
 @app.route('/inventory/print')
 def inventory_print():
-    products = read_products()
-    return render_template('inventory_print.html', products=products)
+    return render_cached('inventory_print.html', product_store.current_version(),
+                         lambda: {'products': read_products()})
 
 
 @app.route('/facial-recognition')
 def facial_recognition():
     """Página de reconocimiento facial"""
-    users = read_users()
-    return render_template('facial_recognition.html', users=users)
+    return render_cached('facial_recognition.html', user_store.current_version(),
+                         lambda: {'users': read_users()})
 
 
 @app.route('/dashboard')
 def dashboard():
     """Dashboard de gestión de usuarios"""
-    users = read_users()
-    # Agregar información de reconocimiento facial a cada usuario
-    total_points = 0
-    users_with_facial = 0
-    for user in users:
-        user['has_facial'] = has_facial_encoding(user['id'])
-        total_points += int(user.get('puntos', 0))
-        if user['has_facial']:
-            users_with_facial += 1
-    
-    return render_template('dashboard.html', 
-                         users=users, 
-                         total_users=len(users),
-                         users_with_facial=users_with_facial,
-                         total_points=total_points)
+    facial_ids = facial_encoding_ids()
+    
+    def context():
+        # Agregar información de reconocimiento facial a cada usuario
+        users = [dict(u, has_facial=u['id'] in facial_ids) for u in read_users()]
+        return {
+            'users': users,
+            'total_users': len(users),
+            'users_with_facial': sum(1 for u in users if u['has_facial']),
+            'total_points': sum(u['puntos'] for u in users),
+        }
+    
+    # Depende de los usuarios y de quiénes tienen rostro registrado
+    return render_cached('dashboard.html', (user_store.current_version(), facial_ids), context)
 
 
 @app.route('/cards')
 def cards():
     """Página de registro de tarjetas"""
-    return render_template('cards.html', entidades_bancarias=ENTIDADES_BANCARIAS)
+    return render_cached('cards.html', context=lambda: {'entidades_bancarias': ENTIDADES_BANCARIAS})
 
 
 def _get_pick_service():
     global _pick_service
+    # Camino rápido sin lock: una vez creado, el servicio no cambia
+    svc = _pick_service
+    if svc is not None:
+        return svc
     if VisionPickService is None:
         return None
     with _pick_service_lock:
@@ -339,10 +1255,7 @@ def _get_pick_service():
 def pick_status():
     svc = _get_pick_service()
     if svc is None:
-        return jsonify({
-            'success': False,
-            'message': 'VisionPickService no disponible (dependencias faltantes o import falló)'
-        }), 503
+        return VISION_NO_DISPONIBLE(), 503
     return jsonify({'success': True, 'status': svc.status()})
 
 
@@ -350,10 +1263,7 @@ def pick_status():
 def pick_start():
     svc = _get_pick_service()
     if svc is None:
-        return jsonify({
-            'success': False,
-            'message': 'VisionPickService no disponible (dependencias faltantes o import falló)'
-        }), 503
+        return VISION_NO_DISPONIBLE(), 503
     svc.start()
     return jsonify({'success': True, 'status': svc.status()})
 
@@ -362,10 +1272,7 @@ def pick_start():
 def pick_stop():
     svc = _get_pick_service()
     if svc is None:
-        return jsonify({
-            'success': False,
-            'message': 'VisionPickService no disponible (dependencias faltantes o import falló)'
-        }), 503
+        return VISION_NO_DISPONIBLE(), 503
     svc.stop()
     return jsonify({'success': True, 'status': svc.status()})
 
@@ -374,10 +1281,7 @@ def pick_stop():
 def pick_events():
     svc = _get_pick_service()
     if svc is None:
-        return jsonify({
-            'success': False,
-            'message': 'VisionPickService no disponible (dependencias faltantes o import falló)'
-        }), 503
+        return VISION_NO_DISPONIBLE(), 503
 
     try:
         limit = int(request.args.get('limit', '50'))
@@ -398,20 +1302,26 @@ def get_product(code):
         puntos = calculate_product_points(product['precio'])
         product_with_points = product.copy()
         product_with_points['puntos'] = puntos
-        return jsonify({
+        if product.get('imagen'):
+            product_with_points['imagen_url'] = product_image_url(product['imagen'])
+        return conditional_json({
             'success': True,
             'product': product_with_points,
             'decoded': decoded
         })
-    return jsonify({
-        'success': False,
-        'message': 'Producto no encontrado'
-    })
+    return PRODUCTO_NO_ENCONTRADO()
 
 
 @app.route('/api/product/<code>/image', methods=['POST'])
 def upload_product_image(code):
     """Sube una imagen y la asocia a un producto (guarda ruta en products.csv)"""
+    # Rechazar antes de que Werkzeug procese el cuerpo del request
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_SIZE:
+        return jsonify({
+            'success': False,
+            'message': 'La imagen supera el tamaño máximo permitido (8 MB)'
+        }), 413
+
     if 'image' not in request.files:
         return jsonify({
             'success': False,
@@ -425,42 +1335,55 @@ def upload_product_image(code):
             'message': 'Archivo inválido'
         })
 
-    products = read_products()
-    product = next((p for p in products if p.get('codigo') == code), None)
-    if not product:
-        return jsonify({
-            'success': False,
-            'message': 'Producto no encontrado'
-        })
-
     ext = Path(image.filename).suffix.lower()
-    if ext not in {'.jpg', '.jpeg', '.png', '.webp'}:
+    if ext not in ALLOWED_IMAGE_EXTS or not is_supported_image(image.stream):
         return jsonify({
             'success': False,
             'message': 'Formato no soportado (usar jpg, png, webp)'
         })
 
+    product = find_product_by_code(code)
+    if not product:
+        return PRODUCTO_NO_ENCONTRADO()
+
     os.makedirs(PRODUCT_IMAGES_DIR, exist_ok=True)
     filename = f"{code}{ext}"
     save_path = os.path.join(PRODUCT_IMAGES_DIR, filename)
-    image.save(save_path)
+    save_uploaded_file(image, save_path)
 
-    product['imagen'] = filename
-    write_products(products)
+    product_store.update(code, {'imagen': filename})
 
     return jsonify({
         'success': True,
         'message': 'Imagen actualizada',
         'image_filename': filename,
-        'image_url': f"/uploads/product_images/{filename}"
+        'image_url': product_image_url(filename)
     })
 
 
 @app.route('/uploads/product_images/<path:filename>')
 def serve_product_image(filename):
     from flask import send_from_directory
-
-    return send_from_directory(PRODUCT_IMAGES_DIR, filename)
+    from werkzeug.utils import safe_join
+
+    if PRODUCT_IMAGES_ACCEL_PREFIX:
+        # nginx envía el archivo (sendfile) y resuelve los 304; Flask solo
+        # valida la ruta y responde con el header
+        path = safe_join(PRODUCT_IMAGES_DIR, filename)
+        if path is None or not os.path.isfile(path):
+            return jsonify({'success': False, 'message': 'Imagen no encontrada'}), 404
+        response = Response(status=200)
+        response.headers['X-Accel-Redirect'] = PRODUCT_IMAGES_ACCEL_PREFIX.rstrip('/') + '/' + filename
+        response.headers['Cache-Control'] = f'public, max-age={PRODUCT_IMAGE_MAX_AGE}, immutable'
+        del response.headers['Content-Type']
+        return response
+
+    # Respuesta condicional (304 con If-Modified-Since/ETag) y cacheable: la URL
+    # cambia con cada subida porque incluye ?v=<mtime>
+    response = send_from_directory(PRODUCT_IMAGES_DIR, filename, conditional=True,
+                                   max_age=PRODUCT_IMAGE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={PRODUCT_IMAGE_MAX_AGE}, immutable'
+    return response
 
 
 @app.route('/api/product/relink', methods=['POST'])
@@ -482,43 +1405,30 @@ def relink_product_code():
             'message': 'Sin cambios'
         })
 
-    products = read_products()
-
-    if any(p.get('codigo') == new_code for p in products):
+    # La unicidad del nuevo código se verifica dentro de la sección crítica
+    product = product_store.update(old_code, {'codigo': new_code})
+    if product is None:
+        return PRODUCTO_NO_ENCONTRADO()
+    if product is False:
         return jsonify({
             'success': False,
             'message': 'Ya existe un producto con el nuevo código'
         })
 
-    updated = False
-    for i, product in enumerate(products):
-        if product.get('codigo') == old_code:
-            products[i]['codigo'] = new_code
-
-            image_filename = product.get('imagen')
-            if image_filename:
-                old_path = os.path.join(PRODUCT_IMAGES_DIR, image_filename)
-                old_ext = Path(image_filename).suffix.lower()
-                if old_ext and os.path.exists(old_path):
-                    new_filename = f"{new_code}{old_ext}"
-                    new_path = os.path.join(PRODUCT_IMAGES_DIR, new_filename)
-                    if not os.path.exists(new_path):
-                        try:
-                            os.rename(old_path, new_path)
-                            products[i]['imagen'] = new_filename
-                        except OSError:
-                            pass
-
-            updated = True
-            break
-
-    if not updated:
-        return jsonify({
-            'success': False,
-            'message': 'Producto no encontrado'
-        })
+    image_filename = product.get('imagen')
+    if image_filename:
+        old_path = os.path.join(PRODUCT_IMAGES_DIR, image_filename)
+        old_ext = Path(image_filename).suffix.lower()
+        if old_ext and os.path.exists(old_path):
+            new_filename = f"{new_code}{old_ext}"
+            new_path = os.path.join(PRODUCT_IMAGES_DIR, new_filename)
+            if not os.path.exists(new_path):
+                try:
+                    os.rename(old_path, new_path)
+                    product_store.update(new_code, {'imagen': new_filename})
+                except OSError:
+                    pass
 
-    write_products(products)
     return jsonify({
         'success': True,
         'message': 'Código actualizado',
@@ -533,25 +1443,16 @@ def add_product():
     data = request.json
     
     # Validar datos requeridos
-    required = ['codigo', 'nombre', 'categoria', 'precio', 'pais', 'proveedor', 'stock']
-    for field in required:
+    for field in PRODUCT_REQUIRED_FIELDS:
         if field not in data or not data[field]:
             return jsonify({
                 'success': False,
                 'message': f'Campo requerido: {field}'
             })
     
-    # Verificar si el código ya existe
-    if find_product_by_code(data['codigo']):
-        return jsonify({
-            'success': False,
-            'message': 'Ya existe un producto con este código'
-        })
-    
-    # Agregar el producto
-    products = read_products()
-    products.append({
-        'codigo': data['codigo'],
+    # Agregar el producto (None si el código ya existe)
+    product = product_store.add({
+        'codigo': str(data['codigo']),
         'nombre': data['nombre'],
         'categoria': data['categoria'],
         'precio': data['precio'],
@@ -559,7 +1460,12 @@ def add_product():
         'proveedor': data['proveedor'],
         'stock': data['stock']
     })
-    write_products(products)
+    
+    if product is None:
+        return jsonify({
+            'success': False,
+            'message': 'Ya existe un producto con este código'
+        })
     
     return jsonify({
         'success': True,
@@ -571,36 +1477,39 @@ def add_product():
 def update_product(code):
     """API para actualizar un producto"""
     data = request.json
-    products = read_products()
-    
-    for i, product in enumerate(products):
-        if product['codigo'] == code:
-            products[i].update(data)
-            write_products(products)
-            return jsonify({
-                'success': True,
-                'message': 'Producto actualizado'
-            })
+
+    # Las columnas que empiezan con '_' quedan reservadas (no son datos del producto)
+    if not isinstance(data, dict) or any(not isinstance(k, str) or k.startswith('_') for k in data):
+        return jsonify({
+            'success': False,
+            'message': 'Campos no válidos'
+        })
+
+    # Las claves del store son texto, como las que llegan en la URL
+    if 'codigo' in data:
+        data['codigo'] = str(data['codigo'])
+
+    product = product_store.update(code, data)
+    if product is None:
+        return PRODUCTO_NO_ENCONTRADO()
+    if product is False:
+        return jsonify({
+            'success': False,
+            'message': 'Ya existe un producto con este código'
+        })
     
     return jsonify({
-        'success': False,
-        'message': 'Producto no encontrado'
+        'success': True,
+        'message': 'Producto actualizado'
     })
 
 
 @app.route('/api/product/<code>', methods=['DELETE'])
 def delete_product(code):
     """API para eliminar un producto"""
-    products = read_products()
-    new_products = [p for p in products if p['codigo'] != code]
+    if not product_store.delete(code):
+        return PRODUCTO_NO_ENCONTRADO()
     
-    if len(new_products) == len(products):
-        return jsonify({
-            'success': False,
-            'message': 'Producto no encontrado'
-        })
-    
-    write_products(new_products)
     return jsonify({
         'success': True,
         'message': 'Producto eliminado'
@@ -610,11 +1519,14 @@ def delete_product(code):
 @app.route('/api/products')
 def get_all_products():
     """API para obtener todos los productos"""
-    products = read_products()
-    return jsonify({
-        'success': True,
-        'products': products
-    })
+    body, etag = product_store.cached_json()
+    if body is None:
+        # Primera lectura después de un cambio: se serializa mientras se envía
+        return Response(product_store.json_chunks(), mimetype='application/json')
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route('/api/user/current')
@@ -630,25 +1542,25 @@ def get_current_user():
                 'puntos': int(user['puntos'])
             }
         })
-    return jsonify({
-        'success': False,
-        'message': 'Usuario no encontrado'
-    })
+    return USUARIO_NO_ENCONTRADO()
+
+
+def default_user_fields(user_id):
+    """Columnas de un usuario creado automáticamente, que dependen de su ID"""
+    return {'nombre': f'Usuario {user_id}'}
 
 
 @app.route('/api/purchase/recognize', methods=['POST'])
 def recognize_or_create_user():
     """API para reconocer usuario desde imagen facial o crear uno por defecto"""
-    data = request.json
+    _, facial_image = facial_request('facial_image')
     
-    if 'facial_image' not in data or not data['facial_image']:
+    if not facial_image:
         return jsonify({
             'success': False,
             'message': 'Imagen facial requerida'
         })
     
-    facial_image = data['facial_image']
-    
     # Intentar reconocer al usuario
     recognition_result = recognize_face(facial_image, tolerance=0.6)
     
@@ -658,38 +1570,16 @@ def recognize_or_create_user():
     if recognition_result['success'] and recognition_result['user_id']:
         # Usuario reconocido
         user_id = recognition_result['user_id']
-        users = read_users()
-        user = next((u for u in users if u['id'] == user_id), None)
+        user = user_store.get(user_id)
     else:
-        # No se reconoció usuario, crear uno por defecto
-        users = read_users()
-        
-        # Generar nuevo ID
-        if users:
-            max_id = max(int(u['id']) for u in users)
-            new_id = str(max_id + 1)
-        else:
-            new_id = '1'
-        
-        # Crear usuario por defecto
-        new_user = {
-            'id': new_id,
-            'nombre': f'Usuario {new_id}',
-            'puntos': '1000'
-        }
-        
-        users.append(new_user)
-        write_users(users)
+        # No se reconoció usuario, crear uno por defecto (el ID se asigna
+        # dentro de la sección crítica del store)
+        user = user_store.add({'puntos': '1000'}, fill=default_user_fields)
         
-        # Registrar el rostro del nuevo usuario
-        register_result = register_user_face(new_id, facial_image)
-        
-        if register_result['success']:
-            user = new_user
-            user_created = True
-        else:
-            # Si no se pudo registrar el rostro, igual crear el usuario
-            user = new_user
+        if user is not None:
+            # Registrar el rostro del nuevo usuario; si no se pudo registrar
+            # el rostro, igual queda creado el usuario
+            register_user_face(user['id'], facial_image)
             user_created = True
     
     if not user:
@@ -712,33 +1602,16 @@ def recognize_or_create_user():
 
 def get_or_create_user(user_id):
     """Obtiene un usuario por ID o crea uno nuevo si no existe"""
-    users = read_users()
-    
     # Buscar usuario existente
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = user_store.get(user_id)
     
     if user:
         return user, False
     
-    # Si no existe, crear nuevo usuario
-    if users:
-        max_id = max(int(u['id']) for u in users)
-        new_id = str(max_id + 1)
-    else:
-        new_id = '1'
-    
-    # Crear usuario por defecto
-    new_user = {
-        'id': new_id,
-        'nombre': f'Usuario {new_id}',
-        'puntos': '1000',
-        'compras': '0'
-    }
-    
-    users.append(new_user)
-    write_users(users)
+    # Si no existe, crear nuevo usuario por defecto (None si no se pudo)
+    new_user = user_store.add({'puntos': '1000', 'compras': '0'}, fill=default_user_fields)
     
-    return new_user, True
+    return new_user, new_user is not None
 
 
 @app.route('/api/purchase', methods=['POST'])
@@ -762,16 +1635,18 @@ def purchase_with_points():
     # Obtener producto
     product = find_product_by_code(data['product_code'])
     if not product:
-        return jsonify({
-            'success': False,
-            'message': 'Producto no encontrado'
-        })
+        return PRODUCTO_NO_ENCONTRADO()
     
     # Calcular puntos necesarios
     puntos_necesarios = calculate_product_points(product['precio'])
     
     # Obtener o crear usuario por ID
     user, user_created = get_or_create_user(data['user_id'])
+    if user is None:
+        return jsonify({
+            'success': False,
+            'message': 'No se pudo identificar o crear el usuario'
+        })
     
     puntos_actuales = int(user['puntos'])
     
@@ -792,14 +1667,10 @@ def purchase_with_points():
     compras_actuales = int(user.get('compras') or 0)
     nuevas_compras = compras_actuales + 1
     
-    users = read_users()
-    for i, u in enumerate(users):
-        if u['id'] == user['id']:
-            users[i]['puntos'] = str(nuevos_puntos)
-            users[i]['compras'] = str(nuevas_compras)
-            break
-    
-    write_users(users)
+    user_store.update(user['id'], {
+        'puntos': nuevos_puntos,
+        'compras': str(nuevas_compras)
+    })
     
     response_data = {
         'success': True,
@@ -830,26 +1701,19 @@ def purchase_with_points():
 @app.route('/api/facial/register', methods=['POST'])
 def register_facial():
     """API para registrar el rostro de un usuario"""
-    data = request.json
+    data, image_data = facial_request('image')
     
-    if 'user_id' not in data or 'image' not in data:
+    if 'user_id' not in data or not image_data:
         return jsonify({
             'success': False,
             'message': 'Se requiere user_id e image'
         })
     
     user_id = data['user_id']
-    image_data = data['image']
     
     # Verificar que el usuario existe
-    users = read_users()
-    user_exists = any(u['id'] == user_id for u in users)
-    
-    if not user_exists:
-        return jsonify({
-            'success': False,
-            'message': 'Usuario no encontrado'
-        })
+    if user_store.get(user_id) is None:
+        return USUARIO_NO_ENCONTRADO()
     
     # Registrar el rostro
     result = register_user_face(user_id, image_data)
@@ -859,16 +1723,23 @@ def register_facial():
 @app.route('/api/facial/recognize', methods=['POST'])
 def recognize_facial():
     """API para reconocer un usuario desde una imagen"""
-    data = request.json
+    data, image_data = facial_request('image')
     
-    if 'image' not in data:
+    if not image_data:
         return jsonify({
             'success': False,
             'message': 'Se requiere image'
         })
     
-    image_data = data['image']
-    tolerance = data.get('tolerance', 0.6)
+    try:
+        tolerance = float(data.get('tolerance', 0.6))
+    except (TypeError, ValueError):
+        tolerance = math.nan
+    if not math.isfinite(tolerance) or tolerance < 0:
+        return jsonify({
+            'success': False,
+            'message': 'La tolerancia debe ser un número mayor o igual a 0'
+        })
     
     # Reconocer el rostro
     result = recognize_face(image_data, tolerance)
@@ -876,8 +1747,7 @@ def recognize_facial():
     if result['success']:
         # Obtener información del usuario reconocido
         user_id = result['user_id']
-        users = read_users()
-        user = next((u for u in users if u['id'] == user_id), None)
+        user = user_store.get(user_id)
         
         if user:
             result['user'] = {
@@ -917,36 +1787,26 @@ def create_user():
             'message': 'El nombre es requerido'
         })
     
-    users = read_users()
-    
-    # Generar nuevo ID
-    if users:
-        max_id = max(int(u['id']) for u in users)
-        new_id = str(max_id + 1)
-    else:
-        new_id = '1'
-    
-    # Verificar si el nombre ya existe
-    if any(u['nombre'].lower() == data['nombre'].lower() for u in users):
+    # Crear nuevo usuario (el ID se asigna y el nombre se verifica dentro de
+    # la sección crítica; None si el nombre ya existe)
+    user = user_store.add({
+        'nombre': data['nombre'],
+        'puntos': str(data.get('puntos', 0))
+    })
+    if user is None:
         return jsonify({
             'success': False,
             'message': 'Ya existe un usuario con ese nombre'
         })
     
-    # Crear nuevo usuario
-    new_user = {
-        'id': new_id,
-        'nombre': data['nombre'],
-        'puntos': str(data.get('puntos', 0))
-    }
-    
-    users.append(new_user)
-    write_users(users)
-    
     return jsonify({
         'success': True,
         'message': 'Usuario creado exitosamente',
-        'user': new_user
+        'user': {
+            'id': user['id'],
+            'nombre': user['nombre'],
+            'puntos': user['puntos']
+        }
     })
 
 
@@ -954,59 +1814,46 @@ def create_user():
 def update_user(user_id):
     """API para actualizar un usuario"""
     data = request.json
-    users = read_users()
     
-    user_found = False
-    for i, user in enumerate(users):
-        if user['id'] == user_id:
-            # Actualizar campos permitidos
-            if 'nombre' in data:
-                # Verificar que el nombre no esté duplicado
-                if any(u['nombre'].lower() == data['nombre'].lower() and u['id'] != user_id for u in users):
-                    return jsonify({
-                        'success': False,
-                        'message': 'Ya existe otro usuario con ese nombre'
-                    })
-                users[i]['nombre'] = data['nombre']
-            
-            if 'puntos' in data:
-                users[i]['puntos'] = str(data['puntos'])
-            
-            user_found = True
-            break
-    
-    if not user_found:
+    if user_store.get(user_id) is None:
+        return USUARIO_NO_ENCONTRADO()
+    
+    # Actualizar campos permitidos
+    changes = {}
+    if 'nombre' in data:
+        changes['nombre'] = data['nombre']
+    
+    if 'puntos' in data:
+        changes['puntos'] = str(data['puntos'])
+    
+    # El nombre duplicado se detecta dentro de la sección crítica (False)
+    user = user_store.update(user_id, changes)
+    if user is None:
+        return USUARIO_NO_ENCONTRADO()
+    if user is False:
         return jsonify({
             'success': False,
-            'message': 'Usuario no encontrado'
+            'message': 'Ya existe otro usuario con ese nombre'
         })
     
-    write_users(users)
-    
     return jsonify({
         'success': True,
         'message': 'Usuario actualizado exitosamente',
-        'user': users[i] if user_found else None
+        'user': user
     })
 
 
 @app.route('/api/user/<user_id>', methods=['DELETE'])
 def delete_user(user_id):
     """API para eliminar un usuario"""
-    users = read_users()
-    new_users = [u for u in users if u['id'] != user_id]
-    
-    if len(new_users) == len(users):
-        return jsonify({
-            'success': False,
-            'message': 'Usuario no encontrado'
-        })
+    if user_store.get(user_id) is None:
+        return USUARIO_NO_ENCONTRADO()
     
     # Eliminar también el reconocimiento facial si existe
     if has_facial_encoding(user_id):
         delete_user_face(user_id)
     
-    write_users(new_users)
+    user_store.delete(user_id)
     
     return jsonify({
         'success': True,
@@ -1017,14 +1864,10 @@ def delete_user(user_id):
 @app.route('/api/user/<user_id>/check-default-name')
 def check_default_name(user_id):
     """API para verificar si un usuario tiene nombre por defecto"""
-    users = read_users()
-    user = next((u for u in users if u['id'] == user_id), None)
+    user = user_store.get(user_id)
     
     if not user:
-        return jsonify({
-            'success': False,
-            'message': 'Usuario no encontrado'
-        })
+        return USUARIO_NO_ENCONTRADO()
     
     # Verificar si el nombre sigue el patrón por defecto "Usuario {ID}"
     is_default = user['nombre'] == f'Usuario {user_id}'
@@ -1053,38 +1896,28 @@ def update_user_name(user_id):
         })
     
     new_name = data['nombre'].strip()
-    users = read_users()
     
-    user_found = False
-    for i, user in enumerate(users):
-        if user['id'] == user_id:
-            # Verificar que el nombre no esté duplicado
-            if any(u['nombre'].lower() == new_name.lower() and u['id'] != user_id for u in users):
-                return jsonify({
-                    'success': False,
-                    'message': 'Ya existe otro usuario con ese nombre'
-                })
-            
-            users[i]['nombre'] = new_name
-            user_found = True
-            break
-    
-    if not user_found:
+    if user_store.get(user_id) is None:
+        return USUARIO_NO_ENCONTRADO()
+    
+    # El nombre duplicado se detecta dentro de la sección crítica (False)
+    user = user_store.update(user_id, {'nombre': new_name})
+    if user is None:
+        return USUARIO_NO_ENCONTRADO()
+    if user is False:
         return jsonify({
             'success': False,
-            'message': 'Usuario no encontrado'
+            'message': 'Ya existe otro usuario con ese nombre'
         })
     
-    write_users(users)
-    
     return jsonify({
         'success': True,
         'message': 'Nombre actualizado exitosamente',
         'user': {
             'id': user_id,
             'nombre': new_name,
-            'puntos': int(users[i]['puntos']),
-            'compras': int(users[i].get('compras') or 0)
+            'puntos': int(user['puntos']),
+            'compras': int(user.get('compras') or 0)
         }
     })
 
@@ -1092,11 +1925,9 @@ def update_user_name(user_id):
 @app.route('/api/users')
 def get_all_users():
     """API para obtener todos los usuarios con información de reconocimiento facial"""
-    users = read_users()
-    
-    # Agregar información de reconocimiento facial
-    for user in users:
-        user['has_facial'] = has_facial_encoding(user['id'])
+    # Agregar información de reconocimiento facial (una sola lectura de la caché)
+    facial_ids = facial_encoding_ids()
+    users = [dict(u, has_facial=u['id'] in facial_ids) for u in read_users()]
     
     return jsonify({
         'success': True,
@@ -1109,7 +1940,7 @@ def get_all_users():
 @app.route('/api/cards')
 def get_all_cards():
     """API para obtener todas las tarjetas"""
-    cards = read_cards()
+    cards = [dict(c) for c in read_cards()]
     # Enmascarar números de tarjeta para seguridad (mostrar solo últimos 4 dígitos)
     for card in cards:
         if len(card['numero_tarjeta']) > 4:
@@ -1128,8 +1959,7 @@ def add_card():
     data = request.json
     
     # Validar datos requeridos
-    required = ['numero_tarjeta', 'cvv', 'fecha_vencimiento', 'entidad_bancaria', 'tipo_tarjeta']
-    for field in required:
+    for field in CARD_REQUIRED_FIELDS:
         if field not in data or not data[field]:
             return jsonify({
                 'success': False,
@@ -1137,57 +1967,43 @@ def add_card():
             })
     
     # Validar formato de número de tarjeta (debe tener 13-19 dígitos)
-    numero_tarjeta = ''.join(filter(str.isdigit, data['numero_tarjeta']))
-    if len(numero_tarjeta) < 13 or len(numero_tarjeta) > 19:
+    numero_tarjeta = only_digits(data['numero_tarjeta'])
+    if not CARD_NUMBER_RE.fullmatch(numero_tarjeta):
         return jsonify({
             'success': False,
             'message': 'El número de tarjeta debe tener entre 13 y 19 dígitos'
         })
     
     # Validar CVV (debe tener 3 o 4 dígitos)
-    cvv = ''.join(filter(str.isdigit, str(data['cvv'])))
-    if len(cvv) < 3 or len(cvv) > 4:
+    cvv = only_digits(data['cvv'])
+    if not CVV_RE.fullmatch(cvv):
         return jsonify({
             'success': False,
             'message': 'El CVV debe tener 3 o 4 dígitos'
         })
     
     # Validar tipo de tarjeta
-    if data['tipo_tarjeta'] not in ['Débito', 'Crédito']:
+    if data['tipo_tarjeta'] not in TIPOS_TARJETA:
         return jsonify({
             'success': False,
             'message': 'El tipo de tarjeta debe ser Débito o Crédito'
         })
     
-    # Leer tarjetas existentes
-    cards = read_cards()
-    
-    # Generar nuevo ID
-    if cards:
-        max_id = max(int(c['id']) for c in cards)
-        new_id = str(max_id + 1)
-    else:
-        new_id = '1'
-    
-    # Verificar si el número de tarjeta ya existe
-    if any(c['numero_tarjeta'] == numero_tarjeta for c in cards):
-        return jsonify({
-            'success': False,
-            'message': 'Ya existe una tarjeta con este número'
-        })
-    
-    # Crear nueva tarjeta
-    new_card = {
-        'id': new_id,
+    # Crear nueva tarjeta (el ID lo asigna el store)
+    new_card = card_store.add({
         'numero_tarjeta': numero_tarjeta,
         'cvv': cvv,
         'fecha_vencimiento': data['fecha_vencimiento'],
         'entidad_bancaria': data['entidad_bancaria'],
         'tipo_tarjeta': data['tipo_tarjeta']
-    }
+    })
     
-    cards.append(new_card)
-    write_cards(cards)
+    # El número de tarjeta ya existía
+    if new_card is None:
+        return jsonify({
+            'success': False,
+            'message': 'Ya existe una tarjeta con este número'
+        })
     
     return jsonify({
         'success': True,
@@ -1200,81 +2016,67 @@ def add_card():
 def update_card(card_id):
     """API para actualizar una tarjeta"""
     data = request.json
-    cards = read_cards()
-    
-    card_found = False
-    for i, card in enumerate(cards):
-        if card['id'] == card_id:
-            # Validar y actualizar campos permitidos
-            if 'numero_tarjeta' in data:
-                numero_tarjeta = ''.join(filter(str.isdigit, data['numero_tarjeta']))
-                if len(numero_tarjeta) < 13 or len(numero_tarjeta) > 19:
-                    return jsonify({
-                        'success': False,
-                        'message': 'El número de tarjeta debe tener entre 13 y 19 dígitos'
-                    })
-                # Verificar que no esté duplicado
-                if any(c['numero_tarjeta'] == numero_tarjeta and c['id'] != card_id for c in cards):
-                    return jsonify({
-                        'success': False,
-                        'message': 'Ya existe otra tarjeta con este número'
-                    })
-                cards[i]['numero_tarjeta'] = numero_tarjeta
-            
-            if 'cvv' in data:
-                cvv = ''.join(filter(str.isdigit, str(data['cvv'])))
-                if len(cvv) < 3 or len(cvv) > 4:
-                    return jsonify({
-                        'success': False,
-                        'message': 'El CVV debe tener 3 o 4 dígitos'
-                    })
-                cards[i]['cvv'] = cvv
-            
-            if 'fecha_vencimiento' in data:
-                cards[i]['fecha_vencimiento'] = data['fecha_vencimiento']
-            
-            if 'entidad_bancaria' in data:
-                cards[i]['entidad_bancaria'] = data['entidad_bancaria']
-            
-            if 'tipo_tarjeta' in data:
-                if data['tipo_tarjeta'] not in ['Débito', 'Crédito']:
-                    return jsonify({
-                        'success': False,
-                        'message': 'El tipo de tarjeta debe ser Débito o Crédito'
-                    })
-                cards[i]['tipo_tarjeta'] = data['tipo_tarjeta']
-            
-            card_found = True
-            break
-    
-    if not card_found:
+    
+    if find_card_by_id(card_id) is None:
+        return TARJETA_NO_ENCONTRADA()
+    
+    # Validar los campos permitidos
+    changes = {}
+    if 'numero_tarjeta' in data:
+        numero_tarjeta = only_digits(data['numero_tarjeta'])
+        if not CARD_NUMBER_RE.fullmatch(numero_tarjeta):
+            return jsonify({
+                'success': False,
+                'message': 'El número de tarjeta debe tener entre 13 y 19 dígitos'
+            })
+        changes['numero_tarjeta'] = numero_tarjeta
+    
+    if 'cvv' in data:
+        cvv = only_digits(data['cvv'])
+        if not CVV_RE.fullmatch(cvv):
+            return jsonify({
+                'success': False,
+                'message': 'El CVV debe tener 3 o 4 dígitos'
+            })
+        changes['cvv'] = cvv
+    
+    if 'fecha_vencimiento' in data:
+        changes['fecha_vencimiento'] = data['fecha_vencimiento']
+    
+    if 'entidad_bancaria' in data:
+        changes['entidad_bancaria'] = data['entidad_bancaria']
+    
+    if 'tipo_tarjeta' in data:
+        if data['tipo_tarjeta'] not in TIPOS_TARJETA:
+            return jsonify({
+                'success': False,
+                'message': 'El tipo de tarjeta debe ser Débito o Crédito'
+            })
+        changes['tipo_tarjeta'] = data['tipo_tarjeta']
+    
+    # Se actualiza la fila en la caché; None si se eliminó mientras tanto y
+    # False si el número ya es de otra tarjeta (se verifica bajo el bloqueo)
+    card = card_store.update(card_id, changes)
+    if card is None:
+        return TARJETA_NO_ENCONTRADA()
+    if card is False:
         return jsonify({
             'success': False,
-            'message': 'Tarjeta no encontrada'
+            'message': 'Ya existe otra tarjeta con este número'
         })
     
-    write_cards(cards)
-    
     return jsonify({
         'success': True,
         'message': 'Tarjeta actualizada exitosamente',
-        'card': cards[i] if card_found else None
+        'card': card
     })
 
 
 @app.route('/api/card/<card_id>', methods=['DELETE'])
 def delete_card(card_id):
     """API para eliminar una tarjeta"""
-    cards = read_cards()
-    new_cards = [c for c in cards if c['id'] != card_id]
-    
-    if len(new_cards) == len(cards):
-        return jsonify({
-            'success': False,
-            'message': 'Tarjeta no encontrada'
-        })
-    
-    write_cards(new_cards)
+    if not card_store.delete(card_id):
+        return TARJETA_NO_ENCONTRADA()
     
     return jsonify({
         'success': True,
@@ -1287,24 +2089,14 @@ def get_card(card_id):
     """API para obtener una tarjeta por ID"""
     card = find_card_by_id(card_id)
     if card:
-        return jsonify({
+        return conditional_json({
             'success': True,
             'card': card
-        })
-    return jsonify({
-        'success': False,
-        'message': 'Tarjeta no encontrada'
-    })
+        }, private=True)
+    return TARJETA_NO_ENCONTRADA()
 
 
 if __name__ == '__main__':
-    import ssl
-    import os
-    
-    # Inicializar archivos
-    init_users_file()
-    init_cards_file()
-    
     print("\n🚀 Servidor iniciado!")
     print("=" * 50)
     
@@ -1325,11 +2117,11 @@ if __name__ == '__main__':
     print("=" * 50)
     print("Presiona Ctrl+C para detener el servidor\n")
     
-    if cert_exists:
-        # Ejecutar con HTTPS
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain('cert.pem', 'key.pem')
-        app.run(host='0.0.0.0', port=3000, debug=True, ssl_context=context)
-    else:
-        # Ejecutar sin HTTPS
-        app.run(host='0.0.0.0', port=3000, debug=True)
+    # Recargador y depurador sólo si se piden explícitamente (FLASK_DEBUG=1);
+    # en producción usar gunicorn (ver wsgi.py)
+    debug = os.environ.get('FLASK_DEBUG') == '1'
+    
+    # HTTPS sólo para desarrollo; en producción el TLS lo termina nginx
+    # (o gunicorn con --certfile/--keyfile), ver README
+    app.run(host='0.0.0.0', port=3000, debug=debug,
+            ssl_context=('cert.pem', 'key.pem') if cert_exists else None)
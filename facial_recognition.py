@@ -7,37 +7,230 @@ Usa la librería face_recognition para identificar usuarios
 import numpy as np
 import json
 import os
+import sqlite3
+import threading
 from PIL import Image
 import io
 import base64
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# Archivo para almacenar los encodings faciales de los usuarios
-FACIAL_ENCODINGS_FILE = 'facial_encodings.json'
+# OpenCV es opcional: si está, decodifica el JPEG/PNG directo a un array;
+# si no, se usa Pillow
+try:
+    import cv2  # type: ignore
+except ImportError:
+    cv2 = None
+
+
+# Base SQLite con los encodings faciales: una fila por usuario con el vector
+# en binario. En modo WAL los lectores no bloquean al que escribe, y registrar
+# o borrar un rostro toca sólo esa fila
+FACIAL_DB_FILE = 'facial.db'
+# Formatos anteriores; se importan al crear la base
+LEGACY_FACIAL_ENCODINGS_NPZ = 'facial_encodings.npz'
+LEGACY_FACIAL_ENCODINGS_FILE = 'facial_encodings.json'
+
+
+# Lado mayor (en píxeles) al que se reduce la imagen antes de detectar el
+# rostro: el detector recorre todos los píxeles y a esta escala la precisión
+# con un rostro frontal a distancia normal de cámara no cambia
+MAX_DETECTION_SIDE = 640
+
+
+# Los encodings se guardan y comparan en float32: la tolerancia de 0.6 no
+# necesita la precisión de float64 y la matriz ocupa la mitad
+ENCODING_DTYPE = np.float32
+
+
+# Caché en memoria de los encodings, válida mientras la base no cambie
+# ('stamp' es el PRAGMA data_version de la conexión)
+_encodings_cache = {
+    'stamp': None,
+    'encodings': {},
+    'ids': frozenset(),
+    'user_ids': [],
+    'matrix': np.empty((0, 128), dtype=ENCODING_DTYPE),
+}
+_encodings_lock = threading.Lock()
+# Una conexión por proceso: una conexión SQLite no puede pasar por un fork
+_db = {'pid': None, 'conn': None}
+
+
+def _stack(encodings):
+    """Apila los encodings en una matriz (M, 128), fila i <-> i-ésimo ID del dict"""
+    if not encodings:
+        return np.empty((0, 128), dtype=ENCODING_DTYPE)
+    return np.stack(list(encodings.values())).astype(ENCODING_DTYPE, copy=False)
+
+
+def _to_blob(encoding):
+    return np.asarray(encoding, dtype=ENCODING_DTYPE).tobytes()
+
+
+def _set_cache(stamp, user_ids, matrix):
+    _encodings_cache['stamp'] = stamp
+    _encodings_cache['user_ids'] = user_ids
+    _encodings_cache['matrix'] = matrix
+    _encodings_cache['ids'] = frozenset(user_ids)
+    # Cada encoding del dict es una vista de su fila en la matriz
+    _encodings_cache['encodings'] = dict(zip(user_ids, matrix))
+
+
+def _read_legacy_files():
+    """Encodings del .npz o, si no está, del JSON de versiones anteriores"""
+    try:
+        with np.load(LEGACY_FACIAL_ENCODINGS_NPZ, allow_pickle=False) as data:
+            return dict(zip(data['ids'].tolist(), data['vecs']))
+    except FileNotFoundError:
+        pass
+    try:
+        with open(LEGACY_FACIAL_ENCODINGS_FILE, 'rb') as file:
+            raw = file.read()
+    except FileNotFoundError:
+        return {}
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    return {user_id: np.array(encoding_list) for user_id, encoding_list in data.items()}
+
+
+def _connection():
+    """Conexión del proceso actual; la abre (y crea la base) la primera vez"""
+    if _db['pid'] != os.getpid():
+        is_new = not os.path.exists(FACIAL_DB_FILE)
+        conn = sqlite3.connect(FACIAL_DB_FILE, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS enc (user_id TEXT PRIMARY KEY, vec BLOB NOT NULL)')
+            if is_new:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO enc (user_id, vec) VALUES (?, ?)',
+                    [(user_id, _to_blob(encoding)) for user_id, encoding in _read_legacy_files().items()]
+                )
+        _db['pid'] = os.getpid()
+        _db['conn'] = conn
+        _encodings_cache['stamp'] = None
+    return _db['conn']
+
+
+def _refresh_cache():
+    """Vuelve a leer la tabla de encodings sólo si cambió desde la última lectura"""
+    conn = _connection()
+    # data_version cambia cuando otra conexión (otro worker) confirma cambios
+    stamp = conn.execute('PRAGMA data_version').fetchone()[0]
+    if stamp == _encodings_cache['stamp']:
+        return
+    rows = conn.execute('SELECT user_id, vec FROM enc ORDER BY rowid').fetchall()
+    # Sin parseo: los vectores se concatenan tal cual en la matriz
+    user_ids = [user_id for user_id, _ in rows]
+    matrix = np.frombuffer(b''.join(vec for _, vec in rows), dtype=ENCODING_DTYPE).reshape(-1, 128)
+    _set_cache(stamp, user_ids, matrix)
 
 
 def load_facial_encodings():
-    """Carga los encodings faciales desde el archivo JSON"""
-    if os.path.exists(FACIAL_ENCODINGS_FILE):
-        with open(FACIAL_ENCODINGS_FILE, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            # Convertir las listas de vuelta a numpy arrays
-            encodings = {}
-            for user_id, encoding_list in data.items():
-                encodings[user_id] = np.array(encoding_list)
-            return encodings
-    return {}
+    """Carga los encodings faciales (desde la caché en memoria; no modificar el dict)"""
+    with _encodings_lock:
+        _refresh_cache()
+        return _encodings_cache['encodings']
+
+
+def facial_encoding_ids():
+    """Retorna el conjunto de IDs de usuarios con encoding facial registrado"""
+    with _encodings_lock:
+        _refresh_cache()
+        return _encodings_cache['ids']
+
+
+def load_encoding_matrix():
+    """Retorna (user_ids, matriz) con los encodings apilados para comparar en bloque"""
+    with _encodings_lock:
+        _refresh_cache()
+        return _encodings_cache['user_ids'], _encodings_cache['matrix']
+
+
+def _execute_write(sql, params):
+    """Ejecuta una escritura en su propia transacción; retorna las filas afectadas"""
+    with _encodings_lock:
+        conn = _connection()
+        with conn:
+            count = conn.execute(sql, params).rowcount
+        # data_version no cambia con las escrituras propias: releer en la próxima consulta
+        _encodings_cache['stamp'] = None
+        return count
+
+
+def save_user_encoding(user_id, encoding):
+    """Guarda (o reemplaza) el encoding facial de un usuario"""
+    _execute_write('INSERT OR REPLACE INTO enc (user_id, vec) VALUES (?, ?)', (user_id, _to_blob(encoding)))
+
+
+def delete_user_encoding(user_id):
+    """Elimina el encoding facial de un usuario; retorna False si no tenía"""
+    return _execute_write('DELETE FROM enc WHERE user_id = ?', (user_id,)) > 0
 
 
 def save_facial_encodings(encodings):
-    """Guarda los encodings faciales en un archivo JSON"""
-    # Convertir numpy arrays a listas para JSON
-    data = {}
-    for user_id, encoding in encodings.items():
-        data[user_id] = encoding.tolist()
-    
-    with open(FACIAL_ENCODINGS_FILE, 'w', encoding='utf-8') as file:
-        json.dump(data, file)
+    """Reemplaza todos los encodings faciales por los del dict"""
+    with _encodings_lock:
+        conn = _connection()
+        with conn:
+            conn.execute('DELETE FROM enc')
+            conn.executemany(
+                'INSERT INTO enc (user_id, vec) VALUES (?, ?)',
+                [(user_id, _to_blob(encoding)) for user_id, encoding in encodings.items()]
+            )
+        _encodings_cache['stamp'] = None
+
+
+# face_recognition (y dlib) se importa la primera vez que se usa, para que el
+# servidor arranque aunque falle al cargar; el resultado queda guardado: el
+# módulo o la excepción del import fallido (que Python no cachea)
+_face_recognition = None
+
+
+def _fr():
+    """Retorna el módulo face_recognition, o la excepción si no se pudo importar"""
+    global _face_recognition
+    if _face_recognition is None:
+        try:
+            import face_recognition  # type: ignore
+            _face_recognition = face_recognition
+        except Exception as e:
+            print(f"Reconocimiento facial deshabilitado: no se pudo importar face_recognition ({e})")
+            _face_recognition = e
+    return _face_recognition
+
+
+def _decode_image(image_bytes):
+    """Decodifica los bytes de una imagen a un array RGB (alto, ancho, 3)"""
+    if cv2 is not None:
+        bgr = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if bgr is not None:
+            # Mismo número de canales: la conversión se hace sobre el mismo buffer
+            return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=bgr)
+    return _pil_to_array(Image.open(io.BytesIO(image_bytes)))
+
+
+def _pil_to_array(image):
+    # Convertir a RGB si es necesario
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def _downscale(image_array):
+    """Reduce la imagen para que su lado mayor no supere MAX_DETECTION_SIDE"""
+    h, w = image_array.shape[:2]
+    if max(h, w) <= MAX_DETECTION_SIDE:
+        return image_array
+    scale = MAX_DETECTION_SIDE / max(h, w)
+    size = (max(1, int(w * scale)), max(1, int(h * scale)))
+    if cv2 is not None:
+        return cv2.resize(image_array, size, interpolation=cv2.INTER_AREA)
+    return np.asarray(Image.fromarray(image_array).resize(size, Image.BOX))
 
 
 def encode_face_from_image(image_data):
@@ -51,11 +244,8 @@ def encode_face_from_image(image_data):
         encoding: Array numpy con el encoding del rostro, o None si no se encuentra rostro
     """
     try:
-        # Import lazy para evitar que el servidor crashee si face_recognition/dlib falla al cargar
-        try:
-            import face_recognition  # type: ignore
-        except Exception as e:
-            print(f"Reconocimiento facial deshabilitado: no se pudo importar face_recognition ({e})")
+        face_recognition = _fr()
+        if isinstance(face_recognition, Exception):
             return None
 
         # Si es base64, decodificarlo
@@ -63,22 +253,17 @@ def encode_face_from_image(image_data):
             if image_data.startswith('data:image'):
                 # Remover el prefijo data:image/...;base64,
                 image_data = image_data.split(',')[1]
-            image_bytes = base64.b64decode(image_data)
-            image = Image.open(io.BytesIO(image_bytes))
+            image_array = _decode_image(base64.b64decode(image_data))
         elif isinstance(image_data, bytes):
-            image = Image.open(io.BytesIO(image_data))
+            image_array = _decode_image(image_data)
+        elif isinstance(image_data, np.ndarray):
+            image_array = image_data
         else:
-            image = image_data
-        
-        # Convertir a RGB si es necesario
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Convertir PIL Image a numpy array
-        image_array = np.array(image)
+            # PIL Image
+            image_array = _pil_to_array(image_data)
         
         # Detectar y codificar el rostro
-        face_encodings = face_recognition.face_encodings(image_array)
+        face_encodings = face_recognition.face_encodings(_downscale(image_array))
         
         if len(face_encodings) == 0:
             return None
@@ -110,14 +295,8 @@ def register_user_face(user_id, image_data):
             'message': 'No se pudo detectar un rostro en la imagen. Asegúrate de que haya una persona visible.'
         }
     
-    # Cargar encodings existentes
-    encodings = load_facial_encodings()
-    
-    # Guardar el encoding del usuario
-    encodings[user_id] = encoding
-    
-    # Guardar en archivo
-    save_facial_encodings(encodings)
+    # Guardar el encoding del usuario (sólo su fila)
+    save_user_encoding(user_id, encoding)
     
     return {
         'success': True,
@@ -136,10 +315,8 @@ def recognize_face(image_data, tolerance=0.6):
     Returns:
         dict: {'success': bool, 'user_id': str o None, 'distance': float o None, 'message': str}
     """
-    # Import lazy para evitar crash al importar el módulo completo
-    try:
-        import face_recognition  # type: ignore
-    except Exception as e:
+    e = _fr()
+    if isinstance(e, Exception):
         return {
             'success': False,
             'user_id': None,
@@ -159,9 +336,9 @@ def recognize_face(image_data, tolerance=0.6):
         }
     
     # Cargar encodings de usuarios registrados
-    known_encodings = load_facial_encodings()
+    user_ids, known_matrix = load_encoding_matrix()
     
-    if not known_encodings:
+    if not user_ids:
         return {
             'success': False,
             'user_id': None,
@@ -169,17 +346,13 @@ def recognize_face(image_data, tolerance=0.6):
             'message': 'No hay usuarios registrados con reconocimiento facial'
         }
     
-    # Comparar con cada usuario registrado
-    best_match = None
-    best_distance = float('inf')
-    
-    for user_id, known_encoding in known_encodings.items():
-        # Calcular la distancia entre los encodings
-        distance = face_recognition.face_distance([known_encoding], encoding)[0]
-        
-        if distance < best_distance:
-            best_distance = distance
-            best_match = user_id
+    # Comparar con todos los usuarios registrados en una sola operación;
+    # einsum suma los cuadrados fila a fila sin crear otra matriz (M, 128)
+    diffs = known_matrix - encoding.astype(ENCODING_DTYPE)
+    distances = np.sqrt(np.einsum('ij,ij->i', diffs, diffs))
+    best_index = int(np.argmin(distances))
+    best_distance = distances[best_index]
+    best_match = user_ids[best_index]
     
     # Verificar si la distancia está dentro de la tolerancia
     if best_distance <= tolerance:
@@ -200,17 +373,12 @@ def recognize_face(image_data, tolerance=0.6):
 
 def has_facial_encoding(user_id):
     """Verifica si un usuario tiene un encoding facial registrado"""
-    encodings = load_facial_encodings()
-    return user_id in encodings
+    return user_id in facial_encoding_ids()
 
 
 def delete_user_face(user_id):
     """Elimina el encoding facial de un usuario"""
-    encodings = load_facial_encodings()
-    
-    if user_id in encodings:
-        del encodings[user_id]
-        save_facial_encodings(encodings)
+    if delete_user_encoding(user_id):
         return {
             'success': True,
             'message': f'Rostro eliminado para el usuario {user_id}'
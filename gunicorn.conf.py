@@ -0,0 +1,28 @@
+"""
+Configuración de gunicorn para producción
+
+Uso: gunicorn wsgi:app
+"""
+
+import multiprocessing
+
+bind = '0.0.0.0:3000'
+
+# Un worker por núcleo, cada uno con varios hilos
+workers = multiprocessing.cpu_count()
+worker_class = 'gthread'
+threads = 4
+
+# Cargar la app (y sus cachés de CSV) una sola vez en el proceso maestro
+# antes de crear los workers
+preload_app = True
+
+# Mantener abiertas las conexiones (de nginx o de los navegadores) entre
+# requests: evita un handshake TCP/TLS por request
+keepalive = 30
+
+
+def worker_exit(server, worker):
+    """Escribe los cambios que el worker todavía tenga pendientes en los CSV"""
+    from app import flush_all
+    flush_all()
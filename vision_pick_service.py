@@ -8,6 +8,22 @@ def _ms_now() -> int:
     return int(time.time() * 1000)
 
 
+# OpenCV se importa la primera vez que arranca la captura; se guarda el
+# módulo o la excepción, así un import fallido no se reintenta en cada start
+_cv2 = None
+
+
+def _load_cv2():
+    global _cv2
+    if _cv2 is None:
+        try:
+            import cv2  # type: ignore
+            _cv2 = cv2
+        except Exception as e:  # noqa: BLE001
+            _cv2 = e
+    return _cv2
+
+
 class VisionPickService:
     def __init__(
         self,
@@ -21,6 +37,7 @@ class VisionPickService:
         self.roi_id = roi_id
 
         self._lock = threading.Lock()
+        # append/popleft de deque son atómicos: la cola de eventos no usa el lock
         self._events = deque(maxlen=max_events)
 
         self._thread: threading.Thread | None = None
@@ -29,30 +46,32 @@ class VisionPickService:
         self._last_error: str | None = None
         self._last_heartbeat_ms: int | None = None
 
+    # Las lecturas no toman el lock: cada campo es una sola referencia y su
+    # lectura es atómica; el lock sólo serializa las transiciones start/stop
     def is_running(self) -> bool:
-        with self._lock:
-            return self._running
+        return self._running
 
     def status(self) -> dict:
-        with self._lock:
-            return {
-                "running": self._running,
-                "camera_id": self.camera_id,
-                "estante_id": self.estante_id,
-                "roi_id": self.roi_id,
-                "queued_events": len(self._events),
-                "last_error": self._last_error,
-                "last_heartbeat_ms": self._last_heartbeat_ms,
-            }
+        return {
+            "running": self._running,
+            "camera_id": self.camera_id,
+            "estante_id": self.estante_id,
+            "roi_id": self.roi_id,
+            "queued_events": len(self._events),
+            "last_error": self._last_error,
+            "last_heartbeat_ms": self._last_heartbeat_ms,
+        }
 
     def pop_events(self, limit: int = 50) -> list[dict]:
         if limit <= 0:
             return []
-        with self._lock:
-            out = []
-            for _ in range(min(limit, len(self._events))):
+        out = []
+        for _ in range(limit):
+            try:
                 out.append(self._events.popleft())
-            return out
+            except IndexError:
+                break
+        return out
 
     def start(self) -> None:
         with self._lock:
@@ -76,8 +95,7 @@ class VisionPickService:
             self._thread.join(timeout=timeout_s)
 
     def _emit_event(self, payload: dict) -> None:
-        with self._lock:
-            self._events.append(payload)
+        self._events.append(payload)
 
     def _run_loop(self) -> None:
         try:
@@ -95,38 +113,43 @@ class VisionPickService:
         fps = float(os.environ.get("PICK_FPS", "30"))
         hb_period_s = float(os.environ.get("PICK_HEARTBEAT_S", "2.0"))
 
-        try:
-            import cv2  # type: ignore
-        except Exception as e:  # noqa: BLE001
+        cv2 = _load_cv2()
+        if isinstance(cv2, Exception):
             raise RuntimeError(
                 "Falta OpenCV (cv2). Instalá opencv-python y configurá PICK_CAM_SOURCE."
-            ) from e
+            ) from cv2
 
         cap = cv2.VideoCapture(int(source) if source.isdigit() else source)
         if not cap.isOpened():
             raise RuntimeError(f"No se pudo abrir la cámara/source: {source}")
 
-        dt_target = 1.0 / max(fps, 1.0)
-        last_hb = time.time()
-        last_fake_pick = time.time()
+        # Tiempos con reloj monotónico en ns (enteros, inmunes a ajustes del
+        # reloj del sistema); los timestamps publicados siguen siendo de pared
+        dt_target_ns = int(1e9 / max(fps, 1.0))
+        hb_period_ns = int(hb_period_s * 1e9)
+        fake_pick_period_ns = 8 * 10**9
+        demo = os.environ.get("PICK_DEMO", "1") == "1"
+        last_hb = last_fake_pick = next_deadline = time.monotonic_ns()
+        # Buffer del cuadro: read() decodifica sobre él en lugar de reservar un
+        # array nuevo en cada vuelta (lo asigna la primera lectura)
+        frame = None
 
         try:
             while not self._stop_evt.is_set():
-                t0 = time.time()
-
-                ok, frame = cap.read()
+                ok, frame = cap.read(frame)
                 if not ok or frame is None:
+                    frame = None
                     time.sleep(0.05)
+                    next_deadline = time.monotonic_ns()
                     continue
 
-                now = time.time()
-                if (now - last_hb) >= hb_period_s:
-                    with self._lock:
-                        self._last_heartbeat_ms = _ms_now()
+                # Momento en que llegó el cuadro (después de la espera de read)
+                now = read_done = time.monotonic_ns()
+                if (now - last_hb) >= hb_period_ns:
+                    self._last_heartbeat_ms = _ms_now()
                     last_hb = now
 
-                demo = os.environ.get("PICK_DEMO", "1") == "1"
-                if demo and (now - last_fake_pick) >= 8.0:
+                if demo and (now - last_fake_pick) >= fake_pick_period_ns:
                     last_fake_pick = now
                     evt = {
                         "event_type": "PICK",
@@ -143,9 +166,17 @@ class VisionPickService:
                     }
                     self._emit_event(evt)
 
-                dt = time.time() - t0
-                sleep_s = max(0.0, dt_target - dt)
-                if sleep_s:
-                    time.sleep(sleep_s)
+                next_deadline += dt_target_ns
+                now = time.monotonic_ns()
+                if now < next_deadline:
+                    time.sleep((next_deadline - now) / 1e9)
+                else:
+                    # Atrasados. Si el atraso es la espera de read (la cámara da
+                    # menos FPS que PICK_FPS) no hay cuadros viejos encolados; sólo
+                    # si el procesamiento superó el período se descarta uno, sin
+                    # decodificarlo. Después se sigue desde ahora, sin ráfagas.
+                    if now - read_done >= dt_target_ns and not self._stop_evt.is_set():
+                        cap.grab()
+                    next_deadline = time.monotonic_ns()
         finally:
             cap.release()
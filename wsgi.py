@@ -0,0 +1,7 @@
+"""
+Punto de entrada WSGI para servidores de producción
+
+Uso: gunicorn wsgi:app
+"""
+
+from app import app  # noqa: F401